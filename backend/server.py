@@ -1,19 +1,35 @@
-from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, APIRouter, HTTPException, UploadFile, File, Form, Header, Request, Response, WebSocket, WebSocketDisconnect
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import StreamingResponse
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo.errors import DuplicateKeyError, OperationFailure
+from cryptography.exceptions import InvalidTag
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 import os
 import logging
 from pathlib import Path
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, TypeAdapter, ValidationError, field_validator
 from typing import List, Optional
 import uuid
-from datetime import datetime
+import asyncio
+from contextlib import asynccontextmanager
+import json
+import zlib
+from datetime import datetime, timedelta, timezone
+from email.utils import format_datetime, parsedate_to_datetime
 import base64
+import csv
+import hashlib
+import heapq
+import io
+import re
+import zipfile
 import random
 import string
 import bcrypt
 import jwt
+import numpy as np
 from bson import ObjectId
 
 ROOT_DIR = Path(__file__).parent
@@ -28,6 +44,47 @@ db = client[os.environ['DB_NAME']]
 JWT_SECRET = os.environ['JWT_SECRET']
 EMERGENT_LLM_KEY = os.environ.get('EMERGENT_LLM_KEY')
 
+# Delete tombstones are kept this long; older sync cursors must do a full resync
+TOMBSTONE_RETENTION_DAYS = int(os.environ.get('TOMBSTONE_RETENTION_DAYS', '30'))
+# A reserved sync sequence not released within this long is treated as abandoned
+SYNC_INFLIGHT_TIMEOUT_SECONDS = int(os.environ.get('SYNC_INFLIGHT_TIMEOUT_SECONDS', '60'))
+
+# Chats older than this are compacted into monthly archive buckets
+CHAT_ARCHIVE_AFTER_DAYS = int(os.environ.get('CHAT_ARCHIVE_AFTER_DAYS', '90'))
+CHAT_ARCHIVE_INTERVAL_SECONDS = int(os.environ.get('CHAT_ARCHIVE_INTERVAL_SECONDS', '3600'))
+
+# Document encryption at rest - master key is base64 of 32 random bytes.
+# Retired master keys stay readable via DOCUMENT_OLD_MASTER_KEYS="id:key,id:key".
+MASTER_KEY_ID = os.environ.get('DOCUMENT_MASTER_KEY_ID', 'primary')
+MASTER_KEYS = {
+    key_id: AESGCM(base64.b64decode(key))
+    for key_id, key in (
+        entry.split(':', 1)
+        for entry in os.environ.get('DOCUMENT_OLD_MASTER_KEYS', '').split(',') if entry
+    )
+}
+if os.environ.get('DOCUMENT_MASTER_KEY'):
+    MASTER_KEYS[MASTER_KEY_ID] = AESGCM(base64.b64decode(os.environ['DOCUMENT_MASTER_KEY']))
+# Storing medical files unencrypted needs an explicit opt-in (local development only)
+ALLOW_PLAINTEXT_DOCUMENTS = os.environ.get('ALLOW_PLAINTEXT_DOCUMENTS', '').lower() in ('1', 'true', 'yes')
+if MASTER_KEY_ID not in MASTER_KEYS and not ALLOW_PLAINTEXT_DOCUMENTS:
+    raise RuntimeError(
+        "DOCUMENT_MASTER_KEY must be set - refusing to store documents unencrypted "
+        "(set ALLOW_PLAINTEXT_DOCUMENTS=true to override for local development)"
+    )
+DATA_KEY_MAX_AGE_DAYS = int(os.environ.get('DATA_KEY_MAX_AGE_DAYS', '365'))
+KEY_ROTATION_INTERVAL_SECONDS = int(os.environ.get('KEY_ROTATION_INTERVAL_SECONDS', '3600'))
+# A retired data key is kept this long so uploads that picked it up can finish
+DATA_KEY_RETIRE_GRACE_HOURS = int(os.environ.get('DATA_KEY_RETIRE_GRACE_HOURS', '24'))
+
+# Idempotency-Key records are kept this long; duplicates wait this long for the original
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', '24'))
+IDEMPOTENCY_WAIT_SECONDS = int(os.environ.get('IDEMPOTENCY_WAIT_SECONDS', '90'))
+
+# Change notifications - idle sockets get a ping this often
+WS_HEARTBEAT_SECONDS = int(os.environ.get('WS_HEARTBEAT_SECONDS', '25'))
+CHANGE_STREAM_RETRY_SECONDS = int(os.environ.get('CHANGE_STREAM_RETRY_SECONDS', '30'))
+
 # Create the main app without a prefix
 app = FastAPI()
 
@@ -61,6 +118,13 @@ class VerificationVerify(BaseModel):
     phone: str
     code: str
 
+class LabResult(BaseModel):
+    analyte: str  # "glucose", "hba1c", "ldl", ...
+    value: float
+    unit: Optional[str] = None
+    ref_low: Optional[float] = None
+    ref_high: Optional[float] = None
+
 class DocumentCreate(BaseModel):
     title: str
     type: str  # "blood_test", "xray", "prescription", "other"
@@ -68,6 +132,22 @@ class DocumentCreate(BaseModel):
     notes: Optional[str] = None
     file_data: str  # base64 encoded
     file_type: str  # "pdf", "image"
+    lab_results: Optional[List[LabResult]] = None  # only indexed for "blood_test"
+
+class DocumentUpdate(BaseModel):
+    title: Optional[str] = None
+    type: Optional[str] = None
+    date: Optional[datetime] = None
+    notes: Optional[str] = None
+    lab_results: Optional[List[LabResult]] = None
+
+    # Omit a field to keep it; only notes and lab_results may be cleared with null
+    @field_validator("title", "type", "date")
+    @classmethod
+    def reject_null(cls, value):
+        if value is None:
+            raise ValueError("null olamaz")
+        return value
 
 class DocumentResponse(BaseModel):
     id: str
@@ -79,6 +159,7 @@ class DocumentResponse(BaseModel):
     file_data: str
     file_type: str
     created_at: datetime
+    lab_results: Optional[List[LabResult]] = None
 
 class ChatMessage(BaseModel):
     message: str
@@ -89,6 +170,50 @@ class ChatResponse(BaseModel):
     assistant_message: str
     created_at: datetime
 
+class DocumentMeta(BaseModel):
+    id: str
+    user_id: str
+    title: str
+    type: str
+    date: datetime
+    notes: Optional[str]
+    file_type: str
+    created_at: datetime
+    updated_at: datetime
+    lab_results: Optional[List[LabResult]] = None
+
+class LabTrendPoint(BaseModel):
+    doc_id: str
+    date: datetime
+    value: float
+    rolling_mean: float
+    delta: Optional[float]
+    out_of_range: bool
+
+class LabTrendResponse(BaseModel):
+    analyte: str
+    unit: Optional[str]
+    window: int
+    points: List[LabTrendPoint]
+    latest: Optional[float]
+    mean: Optional[float]
+    min: Optional[float]
+    max: Optional[float]
+    change: Optional[float]
+
+class SyncTombstone(BaseModel):
+    kind: str  # "document", "chat"
+    id: str
+    deleted_at: datetime
+
+class SyncResponse(BaseModel):
+    documents: List[DocumentMeta]
+    chats: List[ChatResponse]
+    deleted: List[SyncTombstone]
+    cursor: str
+    has_more: bool
+    reset: bool = False
+
 # Store verification codes (in production, use Redis or similar)
 verification_codes = {}
 
@@ -115,6 +240,317 @@ def verify_token(token: str) -> Optional[str]:
     except:
         return None
 
+# Conditional GET helpers
+# Per-user change counters live in db.user_versions ({_id: user_id, documents: n,
+# documents_at: datetime, chats: n, chats_at: datetime}). Every write bumps the
+# matching counter so list endpoints can build a validator from one indexed
+# lookup instead of reading the result set.
+async def bump_version(user_id: str, collection: str):
+    await db.user_versions.update_one(
+        {"_id": user_id},
+        {"$inc": {collection: 1}, "$set": {f"{collection}_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def get_version(user_id: str, collection: str):
+    """Return (counter, last change time) for a user's collection"""
+    state = await db.user_versions.find_one(
+        {"_id": user_id}, {collection: 1, f"{collection}_at": 1}
+    ) or {}
+    return state.get(collection, 0), state.get(f"{collection}_at")
+
+@asynccontextmanager
+async def sync_write(user_id: str, count: int = 1):
+    """Reserve `count` per-user sync sequence numbers for a write; yields the last one
+
+    Sequences are handed out before the row is written, so writes can commit
+    out of order. Each reservation is listed in user_versions.inflight until
+    the block exits, and /api/sync never returns rows at or past the lowest
+    in-flight sequence.
+    """
+    # Compare-and-set so the reservation and its in-flight marker land together
+    while True:
+        state = await db.user_versions.find_one({"_id": user_id}, {"seq": 1}) or {}
+        current = state.get("seq")
+        first = (current or 0) + 1
+        try:
+            result = await db.user_versions.update_one(
+                {"_id": user_id, "seq": current if current is not None else {"$exists": False}},
+                {
+                    "$set": {"seq": first + count - 1},
+                    "$push": {"inflight": {"seq": first, "at": datetime.utcnow()}}
+                },
+                upsert=True
+            )
+        except DuplicateKeyError:
+            continue  # lost the race to create the user_versions row
+        if result.matched_count or result.upserted_id is not None:
+            break
+    try:
+        yield first + count - 1
+    finally:
+        await db.user_versions.update_one({"_id": user_id}, {"$pull": {"inflight": {"seq": first}}})
+
+async def committed_sync_seq(user_id: str) -> Optional[int]:
+    """Return the highest sequence below every in-flight write, or None if none are pending"""
+    state = await db.user_versions.find_one({"_id": user_id}, {"inflight": 1}) or {}
+    abandoned = datetime.utcnow() - timedelta(seconds=SYNC_INFLIGHT_TIMEOUT_SECONDS)
+    pending = [entry['seq'] for entry in state.get('inflight', []) if entry['at'] >= abandoned]
+    if len(pending) < len(state.get('inflight', [])):
+        await db.user_versions.update_one(
+            {"_id": user_id}, {"$pull": {"inflight": {"at": {"$lt": abandoned}}}}
+        )
+    return min(pending) - 1 if pending else None
+
+# Document Storage
+# File bytes live in db.document_chunks as DOCUMENT_SEGMENT_SIZE segments. Each
+# segment is sealed with AES-256-GCM under its owner's data key, with the
+# document id and segment index as associated data so segments cannot be
+# swapped or reordered. Data keys are stored wrapped by the master key. Uploads
+# and downloads handle one segment at a time, keeping memory per request
+# constant. Documents written before this carry plaintext base64 in file_data
+# until the key rotation pass migrates them.
+DOCUMENT_SEGMENT_SIZE = 1024 * 1024
+data_key_cache = {}
+
+def encryption_enabled() -> bool:
+    return MASTER_KEY_ID in MASTER_KEYS
+
+async def get_active_data_key(user_id: str) -> Optional[str]:
+    """Return the id of the user's current data key, creating one if needed"""
+    if not encryption_enabled():
+        return None
+    record = await db.data_keys.find_one({"user_id": user_id, "active": True}, {"_id": 1})
+    if record:
+        return record['_id']
+    
+    raw_key = AESGCM.generate_key(bit_length=256)
+    nonce = os.urandom(12)
+    key_id = str(uuid.uuid4())
+    try:
+        await db.data_keys.insert_one({
+            "_id": key_id,
+            "user_id": user_id,
+            "master_key_id": MASTER_KEY_ID,
+            "nonce": nonce,
+            "wrapped": MASTER_KEYS[MASTER_KEY_ID].encrypt(nonce, raw_key, user_id.encode()),
+            "active": True,
+            "created_at": datetime.utcnow()
+        })
+    except DuplicateKeyError:
+        # A concurrent request created the active key first
+        return await get_active_data_key(user_id)
+    data_key_cache[key_id] = AESGCM(raw_key)
+    return key_id
+
+def unwrap_data_key(record: dict) -> bytes:
+    master = MASTER_KEYS.get(record['master_key_id'])
+    if not master:
+        raise RuntimeError(f"Master key {record['master_key_id']} is not configured")
+    return master.decrypt(record['nonce'], record['wrapped'], record['user_id'].encode())
+
+async def get_data_key(key_id: str) -> AESGCM:
+    key = data_key_cache.get(key_id)
+    if key is None:
+        record = await db.data_keys.find_one({"_id": key_id})
+        key = data_key_cache[key_id] = AESGCM(unwrap_data_key(record))
+    return key
+
+async def seal_segment(doc_id: str, user_id: str, index: int, key_id: Optional[str], data: bytes) -> dict:
+    chunk = {"_id": f"{doc_id}:{index}", "doc_id": doc_id, "user_id": user_id, "n": index, "key_id": key_id}
+    if key_id is None:
+        chunk["data"] = data
+        return chunk
+    chunk["nonce"] = os.urandom(12)
+    chunk["data"] = (await get_data_key(key_id)).encrypt(chunk["nonce"], data, chunk["_id"].encode())
+    return chunk
+
+async def open_segment(chunk: dict) -> bytes:
+    if chunk['key_id'] is None:
+        return chunk['data']
+    return (await get_data_key(chunk['key_id'])).decrypt(chunk['nonce'], chunk['data'], chunk['_id'].encode())
+
+async def write_document_segments(doc_id: str, user_id: str, read) -> dict:
+    """Encrypt and store content pulled from `read(size)` one segment at a time"""
+    key_id = await get_active_data_key(user_id)
+    segments = size = 0
+    while True:
+        data = await read(DOCUMENT_SEGMENT_SIZE)
+        if not data:
+            break
+        await db.document_chunks.insert_one(await seal_segment(doc_id, user_id, segments, key_id, data))
+        segments += 1
+        size += len(data)
+    return {"size": size, "segments": segments}
+
+async def store_document_content(doc_id: str, user_id: str, read) -> dict:
+    """Store a new document's content, removing partial segments on failure"""
+    try:
+        return await write_document_segments(doc_id, user_id, read)
+    except BaseException:
+        await db.document_chunks.delete_many({"doc_id": doc_id})
+        raise
+
+async def iter_document_content(doc: dict):
+    """Yield a document's plaintext bytes segment by segment"""
+    if 'file_data' in doc:
+        yield base64.b64decode(doc['file_data'])
+        return
+    seen = 0
+    chunks = db.document_chunks.find({"doc_id": doc['_id']}).sort("n", 1).batch_size(4)
+    async for chunk in chunks:
+        if chunk['n'] != seen:
+            raise RuntimeError(f"Document {doc['_id']} is missing segment {seen}")
+        yield await open_segment(chunk)
+        seen += 1
+    if seen != doc.get('segments', seen):
+        raise RuntimeError(f"Document {doc['_id']} is truncated")
+
+async def load_file_data(doc: dict) -> str:
+    """Return a document's content as base64 for the JSON API"""
+    if 'file_data' in doc:
+        return doc['file_data']
+    try:
+        return base64.b64encode(b"".join([data async for data in iter_document_content(doc)])).decode()
+    except (InvalidTag, RuntimeError) as e:
+        logging.error(f"Document decrypt error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Belge okunamadı")
+
+# Idempotency
+# A request carrying an Idempotency-Key claims db.idempotency_keys/{user:scope:key}
+# before doing any work and stores its result there when done. A retry with
+# the same key replays that result; one arriving while the original is still
+# running polls until it finishes. The claim holder renews its lock for as
+# long as it runs, so only a claim whose owner died is taken over once the
+# lock expires. Failed requests release their claim so the client can retry.
+IDEMPOTENCY_LOCK_SECONDS = 120
+
+class IdempotencyClaim:
+    def __init__(self, record_id: str):
+        self.record_id = record_id
+        self.owner = str(uuid.uuid4())
+        self.heartbeat = None
+
+    def start(self) -> "IdempotencyClaim":
+        self.heartbeat = asyncio.create_task(self._renew())
+        return self
+
+    async def _renew(self):
+        while True:
+            await asyncio.sleep(IDEMPOTENCY_LOCK_SECONDS / 4)
+            renewed = await db.idempotency_keys.update_one(
+                {"_id": self.record_id, "owner": self.owner, "status": "pending"},
+                {"$set": {"locked_until": datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)}}
+            )
+            if not renewed.matched_count:
+                return  # completed, released or taken over
+
+    def stop(self):
+        if self.heartbeat:
+            self.heartbeat.cancel()
+
+def fingerprint(payload) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, default=str).encode()).hexdigest()
+
+async def claim_idempotency_key(user_id: str, scope: str, key: Optional[str], payload):
+    """Return (claim, stored result); a stored result means replay it"""
+    if not key:
+        return None, None
+    claim = IdempotencyClaim(f"{user_id}:{scope}:{key}")
+    request_hash = fingerprint(payload)
+    deadline = datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_WAIT_SECONDS)
+    while True:
+        now = datetime.utcnow()
+        try:
+            await db.idempotency_keys.insert_one({
+                "_id": claim.record_id,
+                "owner": claim.owner,
+                "fingerprint": request_hash,
+                "status": "pending",
+                "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS),
+                "created_at": now
+            })
+            return claim.start(), None
+        except DuplicateKeyError:
+            record = await db.idempotency_keys.find_one({"_id": claim.record_id})
+        if not record:
+            continue  # released or expired between insert and read
+        if record['fingerprint'] != request_hash:
+            raise HTTPException(status_code=422, detail="Idempotency-Key farklı bir istekle kullanıldı")
+        if record['status'] == "done":
+            return None, record['result']
+        if record['locked_until'] < now:
+            taken = await db.idempotency_keys.update_one(
+                {"_id": claim.record_id, "status": "pending", "locked_until": record['locked_until']},
+                {"$set": {
+                    "owner": claim.owner,
+                    "locked_until": now + timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS)
+                }}
+            )
+            if taken.modified_count:
+                return claim.start(), None
+        if now > deadline:
+            raise HTTPException(status_code=409, detail="Aynı istek hâlâ işleniyor")
+        await asyncio.sleep(0.25)
+
+async def complete_idempotency_key(claim: Optional[IdempotencyClaim], result: dict):
+    if claim:
+        claim.stop()
+        await db.idempotency_keys.update_one(
+            {"_id": claim.record_id, "owner": claim.owner},
+            {"$set": {"status": "done", "result": result}}
+        )
+
+async def release_idempotency_key(claim: Optional[IdempotencyClaim]):
+    if claim:
+        claim.stop()
+        await db.idempotency_keys.delete_one(
+            {"_id": claim.record_id, "owner": claim.owner, "status": "pending"}
+        )
+
+def make_etag(*parts) -> str:
+    digest = hashlib.sha1(":".join(str(p) for p in parts).encode()).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+def _strip_weak(tag: str) -> str:
+    tag = tag.strip()
+    return tag[2:] if tag.startswith("W/") else tag
+
+def not_modified(request: Request, response: Response, etag: str,
+                 last_modified: Optional[datetime] = None) -> Optional[Response]:
+    """Set validator headers; return a bodyless 304 if the client copy is current"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if last_modified:
+        last_modified = last_modified.replace(tzinfo=timezone.utc, microsecond=0)
+        # HTTP dates have whole-second precision, so a change made during the
+        # current second could still land under the same date. Only advertise
+        # (and honour) Last-Modified once that second is over; until then the
+        # ETag alone validates.
+        if last_modified >= datetime.now(timezone.utc).replace(microsecond=0):
+            last_modified = None
+        else:
+            headers["Last-Modified"] = format_datetime(last_modified, usegmt=True)
+    response.headers.update(headers)
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        candidates = [_strip_weak(t) for t in if_none_match.split(",")]
+        if "*" in candidates or _strip_weak(etag) in candidates:
+            return Response(status_code=304, headers=headers)
+        return None
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and last_modified:
+        try:
+            since = parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return None
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        if last_modified <= since:
+            return Response(status_code=304, headers=headers)
+    return None
+
 # Auth Routes
 @api_router.post("/auth/send-code")
 async def send_verification_code(request: VerificationRequest):
@@ -228,13 +664,51 @@ async def get_current_user(token: str):
 
 # Document Routes
 @api_router.post("/documents", response_model=DocumentResponse)
-async def create_document(document: DocumentCreate, token: str):
+async def create_document(document: DocumentCreate, token: str,
+                          idempotency_key: Optional[str] = Header(None)):
     """Create a new health document"""
     user_id = verify_token(token)
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
+    claim, replay = await claim_idempotency_key(user_id, "documents", idempotency_key, document.model_dump())
+    if replay:
+        # Only the id is stored so retries do not keep a second copy of the file
+        return await get_document_response(user_id, replay['id'])
+    try:
+        return await _create_document(document, user_id, claim)
+    except BaseException:
+        await release_idempotency_key(claim)
+        raise
+
+async def get_document_response(user_id: str, doc_id: str) -> DocumentResponse:
+    doc = await db.documents.find_one({"_id": doc_id, "user_id": user_id})
+    if not doc:
+        raise HTTPException(status_code=404, detail="Belge bulunamadı")
+    
+    return DocumentResponse(
+        id=doc['_id'],
+        user_id=doc['user_id'],
+        title=doc['title'],
+        type=doc['type'],
+        date=doc['date'],
+        notes=doc.get('notes'),
+        file_data=await load_file_data(doc),
+        file_type=doc['file_type'],
+        created_at=doc['created_at'],
+        lab_results=doc.get('lab_results')
+    )
+
+async def _create_document(document: DocumentCreate, user_id: str,
+                           claim: Optional[IdempotencyClaim]) -> DocumentResponse:
+    try:
+        content = base64.b64decode(document.file_data, validate=True)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Geçersiz dosya verisi")
+    await check_lab_units(user_id, document.lab_results)
+    
     doc_id = str(uuid.uuid4())
+    stored = await store_document_content(doc_id, user_id, _async_reader(io.BytesIO(content)))
     doc = {
         "_id": doc_id,
         "user_id": user_id,
@@ -242,11 +716,20 @@ async def create_document(document: DocumentCreate, token: str):
         "type": document.type,
         "date": document.date,
         "notes": document.notes,
-        "file_data": document.file_data,
         "file_type": document.file_type,
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        **stored
     }
-    await db.documents.insert_one(doc)
+    if document.lab_results:
+        doc["lab_results"] = [result.model_dump() for result in document.lab_results]
+    doc["updated_at"] = doc["created_at"]
+    async with sync_write(user_id) as seq:
+        doc["sync_seq"] = seq
+        await db.documents.insert_one(doc)
+    await index_lab_results(doc)
+    await bump_version(user_id, "documents")
+    notify_change(user_id, "document.created", doc_id, doc["sync_seq"])
+    await complete_idempotency_key(claim, {"id": doc_id})
     
     return DocumentResponse(
         id=doc_id,
@@ -257,16 +740,87 @@ async def create_document(document: DocumentCreate, token: str):
         notes=document.notes,
         file_data=document.file_data,
         file_type=document.file_type,
-        created_at=doc['created_at']
+        created_at=doc['created_at'],
+        lab_results=document.lab_results
+    )
+
+def _async_reader(stream):
+    async def read(size: int) -> bytes:
+        return stream.read(size)
+    return read
+
+@api_router.post("/documents/upload", response_model=DocumentMeta)
+async def upload_document(
+    token: str,
+    title: str = Form(...),
+    type: str = Form(...),
+    date: datetime = Form(...),
+    file_type: str = Form(...),
+    notes: Optional[str] = Form(None),
+    lab_results: Optional[str] = Form(None),  # JSON list of LabResult
+    file: UploadFile = File(...)
+):
+    """Create a document from a multipart upload, streaming it into encrypted storage"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
+    results = None
+    if lab_results:
+        try:
+            results = LAB_RESULTS_ADAPTER.validate_json(lab_results)
+        except ValidationError:
+            raise HTTPException(status_code=422, detail="Geçersiz tahlil sonuçları")
+        await check_lab_units(user_id, results)
+    
+    doc_id = str(uuid.uuid4())
+    stored = await store_document_content(doc_id, user_id, file.read)
+    doc = {
+        "_id": doc_id,
+        "user_id": user_id,
+        "title": title,
+        "type": type,
+        "date": date,
+        "notes": notes,
+        "file_type": file_type,
+        "created_at": datetime.utcnow(),
+        **stored
+    }
+    if results:
+        doc["lab_results"] = [result.model_dump() for result in results]
+    doc["updated_at"] = doc["created_at"]
+    async with sync_write(user_id) as seq:
+        doc["sync_seq"] = seq
+        await db.documents.insert_one(doc)
+    await index_lab_results(doc)
+    await bump_version(user_id, "documents")
+    notify_change(user_id, "document.created", doc_id, doc["sync_seq"])
+    
+    return DocumentMeta(
+        id=doc_id,
+        user_id=user_id,
+        title=title,
+        type=type,
+        date=date,
+        notes=notes,
+        file_type=file_type,
+        created_at=doc['created_at'],
+        updated_at=doc['updated_at'],
+        lab_results=results
     )
 
 @api_router.get("/documents", response_model=List[DocumentResponse])
-async def get_documents(token: str):
+async def get_documents(token: str, request: Request, response: Response):
     """Get all documents for the current user"""
     user_id = verify_token(token)
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
+    version, changed_at = await get_version(user_id, "documents")
+    cached = not_modified(request, response, make_etag("documents", user_id, version), changed_at)
+    if cached:
+        return cached
+    
     docs = await db.documents.find({"user_id": user_id}).sort("date", -1).to_list(100)
     
     return [
@@ -277,34 +831,96 @@ async def get_documents(token: str):
             type=doc['type'],
             date=doc['date'],
             notes=doc.get('notes'),
-            file_data=doc['file_data'],
+            file_data=await load_file_data(doc),
             file_type=doc['file_type'],
-            created_at=doc['created_at']
+            created_at=doc['created_at'],
+            lab_results=doc.get('lab_results')
         )
         for doc in docs
     ]
 
 @api_router.get("/documents/{doc_id}", response_model=DocumentResponse)
-async def get_document(doc_id: str, token: str):
+async def get_document(doc_id: str, token: str, request: Request, response: Response):
     """Get a specific document"""
     user_id = verify_token(token)
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
+    # Validate against metadata only so a 304 never pulls file_data off disk
+    meta = await db.documents.find_one(
+        {"_id": doc_id, "user_id": user_id}, {"created_at": 1, "updated_at": 1}
+    )
+    if not meta:
+        raise HTTPException(status_code=404, detail="Belge bulunamadı")
+    
+    modified = meta.get('updated_at', meta['created_at'])
+    cached = not_modified(request, response, make_etag("document", doc_id, modified.isoformat()), modified)
+    if cached:
+        return cached
+    
+    return await get_document_response(user_id, doc_id)
+
+DOCUMENT_MEDIA_TYPES = {"pdf": "application/pdf", "image": "image/jpeg"}
+
+@api_router.get("/documents/{doc_id}/content")
+async def get_document_content(doc_id: str, token: str, request: Request):
+    """Stream a document's original bytes, decrypting one segment at a time"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
     doc = await db.documents.find_one({"_id": doc_id, "user_id": user_id})
     if not doc:
         raise HTTPException(status_code=404, detail="Belge bulunamadı")
     
-    return DocumentResponse(
+    response = StreamingResponse(
+        iter_document_content(doc),
+        media_type=DOCUMENT_MEDIA_TYPES.get(doc['file_type'], "application/octet-stream")
+    )
+    modified = doc.get('updated_at', doc['created_at'])
+    cached = not_modified(request, response, make_etag("document", doc_id, modified.isoformat()), modified)
+    if cached:
+        return cached
+    if 'size' in doc:
+        response.headers["Content-Length"] = str(doc['size'])
+    return response
+
+@api_router.put("/documents/{doc_id}", response_model=DocumentMeta)
+async def update_document(doc_id: str, update: DocumentUpdate, token: str):
+    """Update a document's metadata and lab results"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
+    await check_lab_units(user_id, update.lab_results, doc_id)
+    changes = update.model_dump(exclude_unset=True)
+    changes["updated_at"] = datetime.utcnow()
+    async with sync_write(user_id) as seq:
+        changes["sync_seq"] = seq
+        previous = await db.documents.find_one_and_update(
+            {"_id": doc_id, "user_id": user_id},
+            {"$set": changes},
+            projection=SYNC_DOCUMENT_FIELDS
+        )
+    if not previous:
+        raise HTTPException(status_code=404, detail="Belge bulunamadı")
+    doc = {**previous, **changes}
+    await unindex_lab_results(previous)
+    await index_lab_results(doc)
+    await bump_version(user_id, "documents")
+    notify_change(user_id, "document.updated", doc_id, doc["sync_seq"])
+    
+    return DocumentMeta(
         id=doc['_id'],
         user_id=doc['user_id'],
         title=doc['title'],
         type=doc['type'],
         date=doc['date'],
         notes=doc.get('notes'),
-        file_data=doc['file_data'],
         file_type=doc['file_type'],
-        created_at=doc['created_at']
+        created_at=doc['created_at'],
+        updated_at=doc['updated_at'],
+        lab_results=doc.get('lab_results')
     )
 
 @api_router.delete("/documents/{doc_id}")
@@ -314,15 +930,167 @@ async def delete_document(doc_id: str, token: str):
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
-    result = await db.documents.delete_one({"_id": doc_id, "user_id": user_id})
-    if result.deleted_count == 0:
+    deleted = await db.documents.find_one_and_delete(
+        {"_id": doc_id, "user_id": user_id}, projection=SYNC_DOCUMENT_FIELDS
+    )
+    if not deleted:
         raise HTTPException(status_code=404, detail="Belge bulunamadı")
+    await db.document_chunks.delete_many({"doc_id": doc_id})
+    await unindex_lab_results(deleted)
+    async with sync_write(user_id) as seq:
+        tombstone = {
+            "_id": str(uuid.uuid4()),
+            "user_id": user_id,
+            "kind": "document",
+            "item_id": doc_id,
+            "sync_seq": seq,
+            "deleted_at": datetime.utcnow()
+        }
+        await db.tombstones.insert_one(tombstone)
+    await bump_version(user_id, "documents")
+    notify_change(user_id, "document.deleted", doc_id, tombstone["sync_seq"])
     
     return {"message": "Belge silindi"}
 
+# Lab Series
+# Each (user, analyte) pair has one db.lab_series document holding parallel
+# arrays - doc_ids, dates, values, ref_low, ref_high - so a trend query is a
+# single read plus vectorized math. Blood test writes push to the arrays;
+# edits and deletes rewrite them, guarded by the `rev` counter.
+# A series has one unit; results in any other unit are rejected rather than
+# averaged together (a result without a unit is taken to be in the series unit).
+LAB_SERIES_COLUMNS = ("doc_ids", "dates", "values", "ref_low", "ref_high")
+LAB_RESULTS_ADAPTER = TypeAdapter(List[LabResult])
+
+def normalize_analyte(analyte: str) -> str:
+    return analyte.strip().lower()
+
+async def check_lab_units(user_id: str, lab_results: Optional[List[LabResult]], doc_id: Optional[str] = None):
+    """Raise 400 if a result's unit differs from its series (ignoring `doc_id`'s own points)"""
+    expected = {}
+    for result in lab_results or []:
+        if not result.unit:
+            continue
+        analyte = normalize_analyte(result.analyte)
+        if analyte not in expected:
+            series = await db.lab_series.find_one({"_id": f"{user_id}:{analyte}"}, {"unit": 1, "doc_ids": 1})
+            others = series and any(other != doc_id for other in series['doc_ids'])
+            expected[analyte] = series['unit'] if others and series.get('unit') else result.unit
+        if result.unit != expected[analyte]:
+            raise HTTPException(
+                status_code=400,
+                detail=f"{analyte} için birim {expected[analyte]} olmalı (gönderilen: {result.unit})"
+            )
+
+async def index_lab_results(doc: dict):
+    if doc['type'] != "blood_test":
+        return
+    for result in doc.get('lab_results') or []:
+        analyte = normalize_analyte(result['analyte'])
+        query = {"_id": f"{doc['user_id']}:{analyte}"}
+        update = {
+            "$setOnInsert": {"user_id": doc['user_id'], "analyte": analyte},
+            "$push": {
+                "doc_ids": doc['_id'],
+                "dates": doc['date'],
+                "values": result['value'],
+                "ref_low": result.get('ref_low'),
+                "ref_high": result.get('ref_high')
+            },
+            "$inc": {"rev": 1}
+        }
+        if result.get('unit'):
+            # Guards against a concurrent write that fixed a different unit first
+            query["unit"] = {"$in": [result['unit'], None]}
+            update["$set"] = {"unit": result['unit']}
+        try:
+            await db.lab_series.update_one(query, update, upsert=True)
+        except DuplicateKeyError:
+            logging.error(f"Lab unit mismatch: {analyte} {result['unit']} not added for document {doc['_id']}")
+
+async def unindex_lab_results(doc: dict):
+    if doc.get('type') != "blood_test" or not doc.get('lab_results'):
+        return
+    async for series in db.lab_series.find({"user_id": doc['user_id'], "doc_ids": doc['_id']}):
+        while series:
+            keep = [doc_id != doc['_id'] for doc_id in series['doc_ids']]
+            columns = {
+                column: [value for value, kept in zip(series[column], keep) if kept]
+                for column in LAB_SERIES_COLUMNS
+            }
+            if not columns["values"]:
+                # An emptied series no longer pins its unit
+                columns["unit"] = None
+            result = await db.lab_series.update_one(
+                {"_id": series['_id'], "rev": series['rev']},
+                {"$set": columns, "$inc": {"rev": 1}}
+            )
+            if result.modified_count:
+                break
+            # Lost a race with another write - reload and try again
+            series = await db.lab_series.find_one({"_id": series['_id']})
+
+def _optional_float(value) -> Optional[float]:
+    return None if value is None or np.isnan(value) else float(value)
+
+@api_router.get("/labs/{analyte}/trend", response_model=LabTrendResponse)
+async def get_lab_trend(analyte: str, token: str, window: int = 3, since: Optional[datetime] = None):
+    """Get rolling means, deltas and out-of-range flags for one lab analyte"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
+    analyte = normalize_analyte(analyte)
+    window = max(1, min(window, 50))
+    series = await db.lab_series.find_one({"_id": f"{user_id}:{analyte}"})
+    if not series or not series['values']:
+        raise HTTPException(status_code=404, detail="Bu tahlil için sonuç bulunamadı")
+    
+    dates = np.array(series['dates'], dtype="datetime64[ms]")
+    order = np.argsort(dates, kind="stable")
+    if since:
+        order = order[dates[order] >= np.datetime64(since, "ms")]
+    dates = dates[order]
+    values = np.array(series['values'], dtype=float)[order]
+    ref_low = np.array(series['ref_low'], dtype=float)[order]
+    ref_high = np.array(series['ref_high'], dtype=float)[order]
+    doc_ids = [series['doc_ids'][i] for i in order]
+    
+    count = len(values)
+    sums = np.concatenate(([0.0], np.cumsum(values)))
+    ends = np.arange(1, count + 1)
+    starts = np.maximum(ends - window, 0)
+    rolling = (sums[ends] - sums[starts]) / (ends - starts)
+    deltas = np.diff(values, prepend=np.nan)
+    # NaN bounds compare False, so a missing reference never flags a value
+    flags = (values < ref_low) | (values > ref_high)
+    
+    return LabTrendResponse(
+        analyte=analyte,
+        unit=series.get('unit'),
+        window=window,
+        points=[
+            LabTrendPoint(
+                doc_id=doc_ids[i],
+                date=dates[i].astype(datetime),
+                value=float(values[i]),
+                rolling_mean=float(rolling[i]),
+                delta=_optional_float(deltas[i]),
+                out_of_range=bool(flags[i])
+            )
+            for i in range(count)
+        ],
+        latest=float(values[-1]) if count else None,
+        mean=float(values.mean()) if count else None,
+        min=float(values.min()) if count else None,
+        max=float(values.max()) if count else None,
+        change=float(values[-1] - values[0]) if count else None
+    )
+
 # Chat Routes
 @api_router.post("/chat", response_model=ChatResponse)
-async def chat_with_assistant(message: ChatMessage, token: str):
+async def chat_with_assistant(message: ChatMessage, token: str,
+                              idempotency_key: Optional[str] = Header(None)):
     """Chat with health assistant"""
     from emergentintegrations.llm.chat import LlmChat, UserMessage
     
@@ -330,6 +1098,10 @@ async def chat_with_assistant(message: ChatMessage, token: str):
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
+    claim, replay = await claim_idempotency_key(user_id, "chat", idempotency_key, message.model_dump())
+    if replay:
+        return ChatResponse(**replay)
+    
     system_message = """Sen VitaMed uygulamasının sağlık asistanısın. Türkçe konuşuyorsun.
 
 Görevin:
@@ -357,33 +1129,61 @@ Görevin:
         
         # Save to database
         chat_id = str(uuid.uuid4())
-        chat_doc = {
-            "_id": chat_id,
-            "user_id": user_id,
-            "user_message": message.message,
-            "assistant_message": response,
-            "created_at": datetime.utcnow()
-        }
-        await db.chats.insert_one(chat_doc)
+        async with sync_write(user_id) as seq:
+            chat_doc = {
+                "_id": chat_id,
+                "user_id": user_id,
+                "user_message": message.message,
+                "assistant_message": response,
+                "created_at": datetime.utcnow(),
+                "sync_seq": seq
+            }
+            await db.chats.insert_one(chat_doc)
+        await bump_version(user_id, "chats")
+        notify_change(user_id, "chat.created", chat_id, chat_doc["sync_seq"])
         
-        return ChatResponse(
+        result = ChatResponse(
             id=chat_id,
             user_message=message.message,
             assistant_message=response,
             created_at=chat_doc['created_at']
         )
+        await complete_idempotency_key(claim, result.model_dump())
+        return result
     except Exception as e:
+        await release_idempotency_key(claim)
         logging.error(f"Chat error: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Asistan yanıt veremedi: {str(e)}")
+    except BaseException:
+        # Cancelled requests must not leave a pending claim behind
+        await release_idempotency_key(claim)
+        raise
 
 @api_router.get("/chat/history", response_model=List[ChatResponse])
-async def get_chat_history(token: str):
-    """Get chat history for the current user"""
+async def get_chat_history(token: str, request: Request, response: Response,
+                           before: Optional[datetime] = None, limit: int = 50):
+    """Get chat history for the current user, newest first, paging into archives"""
     user_id = verify_token(token)
     if not user_id:
         raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
     
-    chats = await db.chats.find({"user_id": user_id}).sort("created_at", -1).to_list(50)
+    if before and before.tzinfo:
+        # Stored timestamps are naive UTC; archive entries are compared in Python
+        before = before.astimezone(timezone.utc).replace(tzinfo=None)
+    limit = max(1, min(limit, 200))
+    version, changed_at = await get_version(user_id, "chats")
+    etag = make_etag("chats", user_id, version, before, limit)
+    cached = not_modified(request, response, etag, changed_at)
+    if cached:
+        return cached
+    
+    query = {"user_id": user_id}
+    if before:
+        query["created_at"] = {"$lt": before}
+    chats = await db.chats.find(query).sort("created_at", -1).to_list(limit)
+    if len(chats) < limit:
+        older_than = chats[-1]['created_at'] if chats else before
+        chats += await read_archived_chats(user_id, older_than, limit - len(chats))
     
     return [
         ChatResponse(
@@ -395,6 +1195,620 @@ async def get_chat_history(token: str):
         for chat in chats
     ]
 
+# Chat Archive
+# Exchanges older than CHAT_ARCHIVE_AFTER_DAYS move out of db.chats into one
+# db.chat_archives bucket per user and month. Each bucket entry keeps the
+# message pair as a zlib-compressed JSON body so the hot collection and its
+# indexes only grow with recent activity. Entries keep their sync sequence
+# and each bucket tracks the highest one in max_seq, so a full /api/sync
+# still returns archived chats.
+def archive_bucket_id(user_id: str, created_at: datetime) -> str:
+    return f"{user_id}:{created_at.strftime('%Y-%m')}"
+
+def pack_chat(chat: dict) -> dict:
+    body = json.dumps({
+        "user_message": chat['user_message'],
+        "assistant_message": chat['assistant_message']
+    }, ensure_ascii=False).encode()
+    entry = {
+        "id": chat['_id'],
+        "created_at": chat['created_at'],
+        "body": zlib.compress(body, 6)
+    }
+    if chat.get('sync_seq') is not None:
+        entry["sync_seq"] = chat['sync_seq']
+    return entry
+
+def unpack_chat(entry: dict, user_id: str) -> dict:
+    body = json.loads(zlib.decompress(entry['body']))
+    return {
+        "_id": entry['id'],
+        "user_id": user_id,
+        "user_message": body['user_message'],
+        "assistant_message": body['assistant_message'],
+        "created_at": entry['created_at'],
+        "sync_seq": entry.get('sync_seq')
+    }
+
+async def read_archived_chats(user_id: str, before: Optional[datetime], limit: int) -> List[dict]:
+    """Read up to `limit` archived chats older than `before`, newest first"""
+    query = {"user_id": user_id}
+    if before:
+        query["first_at"] = {"$lt": before}
+    chats = []
+    async for bucket in db.chat_archives.find(query).sort("month", -1):
+        entries = [
+            entry for entry in bucket['messages']
+            if before is None or entry['created_at'] < before
+        ]
+        entries.sort(key=lambda entry: entry['created_at'], reverse=True)
+        chats += [unpack_chat(entry, user_id) for entry in entries[:limit - len(chats)]]
+        if len(chats) >= limit:
+            break
+    return chats
+
+async def read_archived_sync_chats(user_id: str, since_seq: int, committed: Optional[int], limit: int) -> List[dict]:
+    """Read up to `limit` archived chats with a sync sequence in (since_seq, committed], lowest first"""
+    entries = []
+    async for bucket in db.chat_archives.find({"user_id": user_id, "max_seq": {"$gt": since_seq}}).batch_size(1):
+        entries = heapq.nsmallest(limit, entries + [
+            entry for entry in bucket['messages']
+            if entry.get('sync_seq', 0) > since_seq and (committed is None or entry['sync_seq'] <= committed)
+        ], key=lambda entry: entry['sync_seq'])
+    return [unpack_chat(entry, user_id) for entry in entries]
+
+async def compact_chats(batch_size: int = 500) -> int:
+    """Move chats past the archive age into monthly buckets; returns count moved"""
+    cutoff = datetime.utcnow() - timedelta(days=CHAT_ARCHIVE_AFTER_DAYS)
+    moved = 0
+    while True:
+        chats = await db.chats.find({"created_at": {"$lt": cutoff}}).sort("created_at", 1).to_list(batch_size)
+        if not chats:
+            return moved
+        buckets = {}
+        for chat in chats:
+            buckets.setdefault(archive_bucket_id(chat['user_id'], chat['created_at']), []).append(chat)
+        for bucket_id, bucket_chats in buckets.items():
+            # $addToSet keeps a rerun after a crash between push and delete idempotent
+            seqs = [chat['sync_seq'] for chat in bucket_chats if chat.get('sync_seq') is not None]
+            await db.chat_archives.update_one(
+                {"_id": bucket_id},
+                {
+                    "$setOnInsert": {
+                        "user_id": bucket_chats[0]['user_id'],
+                        "month": bucket_chats[0]['created_at'].strftime('%Y-%m')
+                    },
+                    "$addToSet": {"messages": {"$each": [pack_chat(chat) for chat in bucket_chats]}},
+                    "$min": {"first_at": bucket_chats[0]['created_at']},
+                    "$max": {"last_at": bucket_chats[-1]['created_at'], "max_seq": max(seqs, default=0)}
+                },
+                upsert=True
+            )
+        await db.chats.delete_many({"_id": {"$in": [chat['_id'] for chat in chats]}})
+        moved += len(chats)
+
+async def run_chat_compaction():
+    while True:
+        try:
+            moved = await compact_chats()
+            if moved:
+                logger.info(f"Archived {moved} chats")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Chat archive error: {str(e)}")
+        await asyncio.sleep(CHAT_ARCHIVE_INTERVAL_SECONDS)
+
+# Key Rotation
+# Rewraps data keys still under a retired master key, retires data keys older
+# than DATA_KEY_MAX_AGE_DAYS, re-encrypts their segments under the user's new
+# key, and moves legacy plaintext file_data into encrypted segments. Every
+# step works one segment or key at a time and can be interrupted safely.
+MIGRATION_CLAIM_SECONDS = 600
+
+async def rotate_document_keys(batch_size: int = 100) -> int:
+    """Run one rotation pass; returns the number of segments rewritten"""
+    if not encryption_enabled():
+        return 0
+    
+    async for record in db.data_keys.find({"master_key_id": {"$ne": MASTER_KEY_ID}}):
+        nonce = os.urandom(12)
+        wrapped = MASTER_KEYS[MASTER_KEY_ID].encrypt(nonce, unwrap_data_key(record), record['user_id'].encode())
+        await db.data_keys.update_one(
+            {"_id": record['_id']},
+            {"$set": {"master_key_id": MASTER_KEY_ID, "nonce": nonce, "wrapped": wrapped}}
+        )
+    
+    now = datetime.utcnow()
+    cutoff = now - timedelta(days=DATA_KEY_MAX_AGE_DAYS)
+    await db.data_keys.update_many(
+        {"active": True, "created_at": {"$lt": cutoff}},
+        {"$set": {"active": False, "retired_at": now}}
+    )
+    # Keys retired before retired_at was recorded start their grace period now
+    await db.data_keys.update_many({"active": False, "retired_at": {"$exists": False}}, {"$set": {"retired_at": now}})
+    retired = [record['_id'] async for record in db.data_keys.find({"active": False}, {"_id": 1})]
+    
+    rewritten = 0
+    while True:
+        chunks = await db.document_chunks.find({"key_id": {"$in": retired + [None]}}).to_list(batch_size)
+        if not chunks:
+            break
+        for chunk in chunks:
+            key_id = await get_active_data_key(chunk['user_id'])
+            sealed = await seal_segment(chunk['doc_id'], chunk['user_id'], chunk['n'], key_id, await open_segment(chunk))
+            await db.document_chunks.replace_one({"_id": chunk['_id'], "key_id": chunk['key_id']}, sealed)
+            rewritten += 1
+    
+    # Legacy migration is claim-based because every worker runs this pass.
+    # Only the current claim holder touches a document's segments, a pass that
+    # loses a race never deletes segments, and file_data is only dropped while
+    # the claim is held and every segment is in place.
+    while True:
+        now = datetime.utcnow()
+        unclaimed = {
+            "file_data": {"$exists": True},
+            "$or": [{"migration_claim": {"$exists": False}}, {"migration_claim.until": {"$lt": now}}]
+        }
+        docs = await db.documents.find(unclaimed, {"_id": 1, "user_id": 1}).to_list(batch_size)
+        if not docs:
+            break
+        for doc in docs:
+            owner = str(uuid.uuid4())
+            claimed = await db.documents.find_one_and_update(
+                {"_id": doc['_id'], **unclaimed},
+                {"$set": {"migration_claim": {
+                    "owner": owner,
+                    "until": now + timedelta(seconds=MIGRATION_CLAIM_SECONDS)
+                }}},
+                projection={"file_data": 1}
+            )
+            if not claimed:
+                continue
+            content = base64.b64decode(claimed['file_data'])
+            try:
+                await db.document_chunks.delete_many({"doc_id": doc['_id']})
+                stored = await write_document_segments(doc['_id'], doc['user_id'], _async_reader(io.BytesIO(content)))
+            except DuplicateKeyError:
+                # A pass whose claim expired is still writing; retry once our claim lapses
+                continue
+            if await db.document_chunks.count_documents({"doc_id": doc['_id']}) != stored['segments']:
+                continue
+            result = await db.documents.update_one(
+                {"_id": doc['_id'], "file_data": {"$exists": True}, "migration_claim.owner": owner},
+                {"$set": stored, "$unset": {"file_data": "", "migration_claim": ""}}
+            )
+            if result.modified_count:
+                rewritten += stored['segments']
+    
+    # An upload may still be sealing segments with a recently retired key;
+    # those are re-encrypted by a later pass before the key can go
+    expired = datetime.utcnow() - timedelta(hours=DATA_KEY_RETIRE_GRACE_HOURS)
+    async for record in db.data_keys.find({"active": False, "retired_at": {"$lt": expired}}, {"_id": 1}):
+        if not await db.document_chunks.find_one({"key_id": record['_id']}, {"_id": 1}):
+            await db.data_keys.delete_one({"_id": record['_id'], "active": False, "retired_at": {"$lt": expired}})
+            data_key_cache.pop(record['_id'], None)
+    return rewritten
+
+async def run_key_rotation():
+    while True:
+        try:
+            rewritten = await rotate_document_keys()
+            if rewritten:
+                logger.info(f"Re-encrypted {rewritten} document segments")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Key rotation error: {str(e)}")
+        await asyncio.sleep(KEY_ROTATION_INTERVAL_SECONDS)
+
+# Export
+# The archive is written through zipfile onto a non-seekable buffer (entries
+# use data descriptors) that is drained after every segment, so the response
+# starts immediately and memory stays flat however large the archive gets.
+# Document files are stored as-is since PDFs and images are already compressed.
+EXPORT_FILE_EXTENSIONS = {"pdf": "pdf", "image": "jpg"}
+EXPORT_CSV_FIELDS = ["id", "title", "type", "date", "notes", "file_type", "file", "created_at", "updated_at"]
+
+class _ZipSink(io.RawIOBase):
+    def __init__(self):
+        self.pending = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if data:
+            self.pending.append(bytes(data))
+        return len(data)
+
+    def drain(self) -> bytes:
+        data = b"".join(self.pending)
+        self.pending.clear()
+        return data
+
+def export_file_name(doc: dict) -> str:
+    title = re.sub(r"[^\w.-]+", "_", doc['title']).strip("_")[:60] or "belge"
+    extension = EXPORT_FILE_EXTENSIONS.get(doc['file_type'], "bin")
+    return f"documents/{doc['date']:%Y-%m-%d}_{title}_{doc['_id'][:8]}.{extension}"
+
+def export_entry(name: str, timestamp: datetime, compress: bool) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=max(timestamp, datetime(1980, 1, 1)).timetuple()[:6])
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    return info
+
+def export_json(row: dict) -> bytes:
+    return json.dumps(row, ensure_ascii=False, default=lambda value: value.isoformat()).encode()
+
+def export_csv(values: list) -> bytes:
+    line = io.StringIO()
+    csv.writer(line).writerow([
+        value.isoformat() if isinstance(value, datetime) else "" if value is None else value
+        for value in values
+    ])
+    return line.getvalue().encode()
+
+def export_document_row(doc: dict) -> dict:
+    return {
+        "id": doc['_id'],
+        "title": doc['title'],
+        "type": doc['type'],
+        "date": doc['date'],
+        "notes": doc.get('notes'),
+        "file_type": doc['file_type'],
+        "file": export_file_name(doc),
+        "created_at": doc['created_at'],
+        "updated_at": doc.get('updated_at', doc['created_at']),
+        "lab_results": doc.get('lab_results')
+    }
+
+async def iter_export_chats(user_id: str):
+    """Yield every chat oldest first, archived buckets before the hot set"""
+    async for bucket in db.chat_archives.find({"user_id": user_id}).sort("month", 1).batch_size(1):
+        for entry in sorted(bucket['messages'], key=lambda entry: entry['created_at']):
+            yield unpack_chat(entry, user_id)
+    async for chat in db.chats.find({"user_id": user_id}).sort("created_at", 1).batch_size(100):
+        yield chat
+
+async def iter_export(user_id: str):
+    sink = _ZipSink()
+    now = datetime.utcnow()
+    documents = {"user_id": user_id}
+    with zipfile.ZipFile(sink, "w") as archive:
+        async for doc in db.documents.find(documents).sort("date", 1).batch_size(4):
+            info = export_entry(export_file_name(doc), doc['created_at'], compress=False)
+            with archive.open(info, "w", force_zip64=True) as entry:
+                async for data in iter_document_content(doc):
+                    entry.write(data)
+                    if sink.pending:
+                        yield sink.drain()
+        
+        # Manifests are written row by row from metadata-only cursors
+        with archive.open(export_entry("documents.json", now, compress=True), "w") as entry:
+            entry.write(b"[")
+            separator = b"\n"
+            async for doc in db.documents.find(documents, SYNC_DOCUMENT_FIELDS).sort("date", 1):
+                entry.write(separator + export_json(export_document_row(doc)))
+                separator = b",\n"
+                if sink.pending:
+                    yield sink.drain()
+            entry.write(b"\n]\n")
+        if sink.pending:
+            yield sink.drain()
+        
+        with archive.open(export_entry("documents.csv", now, compress=True), "w") as entry:
+            entry.write(export_csv(EXPORT_CSV_FIELDS))
+            async for doc in db.documents.find(documents, SYNC_DOCUMENT_FIELDS).sort("date", 1):
+                row = export_document_row(doc)
+                entry.write(export_csv([row[field] for field in EXPORT_CSV_FIELDS]))
+                if sink.pending:
+                    yield sink.drain()
+        if sink.pending:
+            yield sink.drain()
+        
+        with archive.open(export_entry("chats.json", now, compress=True), "w") as entry:
+            entry.write(b"[")
+            separator = b"\n"
+            async for chat in iter_export_chats(user_id):
+                entry.write(separator + export_json({
+                    "id": chat['_id'],
+                    "user_message": chat['user_message'],
+                    "assistant_message": chat['assistant_message'],
+                    "created_at": chat['created_at']
+                }))
+                separator = b",\n"
+                if sink.pending:
+                    yield sink.drain()
+            entry.write(b"\n]\n")
+    if sink.pending:
+        yield sink.drain()
+
+@api_router.get("/export")
+async def export_archive(token: str):
+    """Stream a ZIP of every document plus JSON/CSV manifests and chat history"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
+    filename = f"vitamed-arsiv-{datetime.utcnow():%Y%m%d}.zip"
+    return StreamingResponse(
+        iter_export(user_id),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+# Sync Routes
+SYNC_DOCUMENT_FIELDS = {"file_data": 0}
+
+def encode_sync_cursor(seq: int, issued: int) -> str:
+    return f"{seq}.{issued}"
+
+def decode_sync_cursor(cursor: str):
+    """Return (seq, issued_at timestamp) for an opaque sync cursor"""
+    try:
+        seq, issued = cursor.split(".")
+        return int(seq), int(issued)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Geçersiz senkronizasyon imleci")
+
+async def backfill_sync_seq(user_id: str):
+    """Assign sync sequence numbers to rows written before delta sync existed"""
+    for collection in (db.documents, db.chats):
+        legacy = await collection.find(
+            {"user_id": user_id, "sync_seq": {"$exists": False}}, {"_id": 1}
+        ).sort("created_at", 1).to_list(None)
+        if not legacy:
+            continue
+        async with sync_write(user_id, len(legacy)) as last:
+            for offset, row in enumerate(legacy):
+                await collection.update_one(
+                    {"_id": row['_id']},
+                    {"$set": {"sync_seq": last - len(legacy) + 1 + offset}}
+                )
+    # Chats archived before archive entries kept their sequence
+    async for bucket in db.chat_archives.find(
+        {"user_id": user_id, "messages": {"$elemMatch": {"sync_seq": {"$exists": False}}}}
+    ):
+        legacy = [entry['id'] for entry in bucket['messages'] if 'sync_seq' not in entry]
+        async with sync_write(user_id, len(legacy)) as last:
+            for offset, entry_id in enumerate(legacy):
+                seq = last - len(legacy) + 1 + offset
+                await db.chat_archives.update_one(
+                    {"_id": bucket['_id'], "messages.id": entry_id},
+                    {"$set": {"messages.$.sync_seq": seq}, "$max": {"max_seq": seq}}
+                )
+
+@api_router.get("/sync", response_model=SyncResponse)
+async def sync_changes(token: str, since: Optional[str] = None, limit: int = 100):
+    """Get documents, chats and deletions changed since a sync cursor"""
+    user_id = verify_token(token)
+    if not user_id:
+        raise HTTPException(status_code=401, detail="Geçersiz veya süresi dolmuş token")
+    
+    limit = max(1, min(limit, 500))
+    reset = False
+    since_seq = 0
+    # The cursor's timestamp is when the client last read everything up to the
+    # present. It is carried forward while paging, so the retention check
+    # measures from the oldest change the client may not have seen yet.
+    issued = int(datetime.utcnow().timestamp())
+    if since:
+        since_seq, since_issued = decode_sync_cursor(since)
+        # Tombstones older than the retention window may already be gone
+        if issued - since_issued > TOMBSTONE_RETENTION_DAYS * 86400:
+            since_seq, reset = 0, True
+        else:
+            pages_from = since_issued
+    if since_seq == 0:
+        await backfill_sync_seq(user_id)
+    
+    query = {"user_id": user_id, "sync_seq": {"$gt": since_seq}}
+    committed = await committed_sync_seq(user_id)
+    if committed is not None:
+        # Rows past an uncommitted write wait for a later sync so the cursor never skips it
+        query["sync_seq"]["$lte"] = committed
+    # Fetch limit + 1 from each source; everything past the merged cut-off
+    # is guaranteed to have a higher sequence than the returned cursor
+    docs = await db.documents.find(query, SYNC_DOCUMENT_FIELDS).sort("sync_seq", 1).to_list(limit + 1)
+    chats = await db.chats.find(query).sort("sync_seq", 1).to_list(limit + 1)
+    # A chat being compacted can briefly sit in both places
+    hot = {chat['_id'] for chat in chats}
+    chats += [
+        chat for chat in await read_archived_sync_chats(user_id, since_seq, committed, limit + 1)
+        if chat['_id'] not in hot
+    ]
+    tombstones = [] if since_seq == 0 else await db.tombstones.find(query).sort("sync_seq", 1).to_list(limit + 1)
+    
+    changes = sorted(
+        [("document", d) for d in docs] + [("chat", c) for c in chats] + [("deleted", t) for t in tombstones],
+        key=lambda change: change[1]['sync_seq']
+    )
+    has_more = len(changes) > limit
+    if has_more and since_seq:
+        issued = pages_from
+    changes = changes[:limit]
+    cursor_seq = changes[-1][1]['sync_seq'] if changes else since_seq
+    
+    return SyncResponse(
+        documents=[
+            DocumentMeta(
+                id=doc['_id'],
+                user_id=doc['user_id'],
+                title=doc['title'],
+                type=doc['type'],
+                date=doc['date'],
+                notes=doc.get('notes'),
+                file_type=doc['file_type'],
+                created_at=doc['created_at'],
+                updated_at=doc.get('updated_at', doc['created_at']),
+                lab_results=doc.get('lab_results')
+            )
+            for kind, doc in changes if kind == "document"
+        ],
+        chats=[
+            ChatResponse(
+                id=chat['_id'],
+                user_message=chat['user_message'],
+                assistant_message=chat['assistant_message'],
+                created_at=chat['created_at']
+            )
+            for kind, chat in changes if kind == "chat"
+        ],
+        deleted=[
+            SyncTombstone(
+                kind=tomb['kind'],
+                id=tomb['item_id'],
+                deleted_at=tomb['deleted_at']
+            )
+            for kind, tomb in changes if kind == "deleted"
+        ],
+        cursor=encode_sync_cursor(cursor_seq, issued),
+        has_more=has_more,
+        reset=reset
+    )
+
+# Change Notifications
+# Each open /api/ws socket owns a bounded queue in `subscribers`. Events come
+# from a MongoDB change stream over documents, chats and tombstones when the
+# deployment supports it (any replica set, including a single-node one); while
+# no stream is open the write paths publish to this process directly instead.
+# Events are hints carrying the sync sequence - clients react by calling
+# /api/sync - so an occasional duplicate is harmless.
+subscribers = {}
+change_feed = {"active": False, "resume_token": None}
+
+# InvalidResumeToken, ChangeStreamFatalError, ChangeStreamHistoryLost
+CHANGE_STREAM_LOST_CODES = {260, 280, 286}
+
+CHANGE_FEED_PIPELINE = [
+    {"$match": {
+        "ns.coll": {"$in": ["documents", "chats", "tombstones"]},
+        "$or": [
+            {"operationType": "insert"},
+            # Only user edits touch updated_at; backfills and re-encryption do not
+            {"operationType": "update", "updateDescription.updatedFields.updated_at": {"$exists": True}}
+        ]
+    }},
+    {"$project": {
+        "operationType": 1,
+        "ns": 1,
+        "documentKey": 1,
+        "fullDocument.user_id": 1,
+        "fullDocument.sync_seq": 1,
+        "fullDocument.kind": 1,
+        "fullDocument.item_id": 1
+    }}
+]
+
+def publish(user_id: str, event: dict):
+    for queue in subscribers.get(user_id, ()):
+        try:
+            queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # Slow consumer - replace its backlog with a single resync hint
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait({"type": "resync", "seq": event['seq']})
+
+async def broadcast_resync():
+    """Tell every connected client to resync from its current sequence"""
+    for user_id in list(subscribers):
+        state = await db.user_versions.find_one({"_id": user_id}, {"seq": 1}) or {}
+        publish(user_id, {"type": "resync", "seq": state.get("seq", 0)})
+
+def notify_change(user_id: str, event_type: str, item_id: str, seq: int):
+    if not change_feed["active"]:
+        publish(user_id, {"type": event_type, "id": item_id, "seq": seq})
+
+def change_event(change: dict):
+    """Map a change stream event to (user_id, notification) or None"""
+    doc = change.get('fullDocument')
+    if not doc:
+        return None
+    collection = change['ns']['coll']
+    if collection == "tombstones":
+        return doc['user_id'], {"type": f"{doc['kind']}.deleted", "id": doc['item_id'], "seq": doc['sync_seq']}
+    action = "created" if change['operationType'] == "insert" else "updated"
+    kind = "document" if collection == "documents" else "chat"
+    return doc['user_id'], {"type": f"{kind}.{action}", "id": change['documentKey']['_id'], "seq": doc.get('sync_seq')}
+
+async def run_change_feed():
+    while True:
+        try:
+            async with db.watch(
+                CHANGE_FEED_PIPELINE,
+                full_document="updateLookup",
+                resume_after=change_feed["resume_token"]
+            ) as stream:
+                change_feed["active"] = True
+                async for change in stream:
+                    change_feed["resume_token"] = stream.resume_token
+                    mapped = change_event(change)
+                    if mapped:
+                        publish(*mapped)
+        except asyncio.CancelledError:
+            raise
+        except OperationFailure as e:
+            if e.code not in CHANGE_STREAM_LOST_CODES:
+                logger.info(f"Change stream unavailable, using in-process notifications: {str(e)}")
+            else:
+                # The resume point fell off the oplog; events since then are gone
+                logger.warning(f"Change stream history lost, restarting from now: {str(e)}")
+                change_feed["resume_token"] = None
+                await broadcast_resync()
+        except Exception as e:
+            logger.info(f"Change stream unavailable, using in-process notifications: {str(e)}")
+        finally:
+            change_feed["active"] = False
+        await asyncio.sleep(CHANGE_STREAM_RETRY_SECONDS)
+
+@api_router.websocket("/ws")
+async def change_notifications(websocket: WebSocket, token: str, resume: Optional[int] = None):
+    """Push document and chat change events for the current user"""
+    user_id = verify_token(token)
+    if not user_id:
+        await websocket.close(code=4401)
+        return
+    await websocket.accept()
+    
+    queue = asyncio.Queue(maxsize=100)
+    subscribers.setdefault(user_id, set()).add(queue)
+    
+    async def receive():
+        # Client pings get a pong; anything else is ignored
+        try:
+            while True:
+                if await websocket.receive_text() == "ping":
+                    await websocket.send_json({"type": "pong"})
+        except WebSocketDisconnect:
+            pass
+    
+    receiver = asyncio.create_task(receive())
+    try:
+        state = await db.user_versions.find_one({"_id": user_id}, {"seq": 1}) or {}
+        seq = state.get("seq", 0)
+        await websocket.send_json({"type": "hello", "seq": seq})
+        if resume is not None and resume < seq:
+            # Events were missed while disconnected
+            await websocket.send_json({"type": "resync", "seq": seq})
+        
+        while not receiver.done():
+            getter = asyncio.create_task(queue.get())
+            done, _ = await asyncio.wait({getter, receiver}, timeout=WS_HEARTBEAT_SECONDS, return_when=asyncio.FIRST_COMPLETED)
+            if getter in done:
+                await websocket.send_json(getter.result())
+            else:
+                getter.cancel()
+                if not done:
+                    await websocket.send_json({"type": "ping"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        receiver.cancel()
+        subscribers[user_id].discard(queue)
+        if not subscribers[user_id]:
+            del subscribers[user_id]
+
 # Health Check
 @api_router.get("/")
 async def root():
@@ -422,6 +1836,40 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def create_indexes():
+    await db.documents.create_index([("user_id", 1), ("sync_seq", 1)])
+    await db.chats.create_index([("user_id", 1), ("sync_seq", 1)])
+    await db.chats.create_index([("user_id", 1), ("created_at", -1)])
+    await db.chats.create_index("created_at")
+    await db.chat_archives.create_index([("user_id", 1), ("month", -1)])
+    await db.chat_archives.create_index([("user_id", 1), ("max_seq", 1)])
+    await db.document_chunks.create_index([("doc_id", 1), ("n", 1)], unique=True)
+    await db.document_chunks.create_index("key_id")
+    await db.lab_series.create_index([("user_id", 1), ("doc_ids", 1)])
+    await db.idempotency_keys.create_index(
+        "created_at", expireAfterSeconds=IDEMPOTENCY_TTL_HOURS * 3600
+    )
+    await db.data_keys.create_index(
+        "user_id", unique=True, partialFilterExpression={"active": True}
+    )
+    await db.tombstones.create_index([("user_id", 1), ("sync_seq", 1)])
+    await db.tombstones.create_index(
+        "deleted_at", expireAfterSeconds=TOMBSTONE_RETENTION_DAYS * 86400
+    )
+
+background_tasks = []
+
+@app.on_event("startup")
+async def start_background_tasks():
+    if not encryption_enabled():
+        logger.warning("!!! DOCUMENT_MASTER_KEY is not set - documents are stored UNENCRYPTED at rest !!!")
+    background_tasks.append(asyncio.create_task(run_chat_compaction()))
+    background_tasks.append(asyncio.create_task(run_key_rotation()))
+    background_tasks.append(asyncio.create_task(run_change_feed()))
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
+    for task in background_tasks:
+        task.cancel()
     client.close()
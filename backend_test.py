@@ -5,11 +5,15 @@ Tests all backend endpoints according to the test_result.md requirements
 """
 
 import requests
+import websocket
 import json
 import base64
+import io
+import zipfile
 from datetime import datetime
 import uuid
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 # Backend URL from frontend .env
 BACKEND_URL = "https://saglikcebimde.preview.emergentagent.com/api"
@@ -24,6 +28,7 @@ class VitaMedAPITester:
         self.test_name = "Ahmet Yılmaz"
         self.verification_code = None
         self.document_id = None
+        self.sync_cursor = None
         
     def log_test(self, test_name, success, details=""):
         status = "✅ PASS" if success else "❌ FAIL"
@@ -271,6 +276,403 @@ class VitaMedAPITester:
             self.log_test("Get Single Document", False, f"Error: {str(e)}")
             return False
     
+    def test_get_document_content(self):
+        """Test GET /documents/{doc_id}/content"""
+        if not self.token or not self.document_id:
+            self.log_test("Get Document Content", False, "No token or document ID available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            response = requests.get(f"{self.base_url}/documents/{self.document_id}/content", 
+                                  params=params, timeout=10)
+            
+            if response.status_code == 200:
+                expected = "Bu bir test belgesidir. VitaMed sağlık uygulaması için oluşturulmuştur."
+                success = response.content.decode() == expected
+                details = f"Status: {response.status_code}, Bytes: {len(response.content)}"
+            else:
+                success = False
+                details = f"Status: {response.status_code}, Response: {response.text}"
+                
+            self.log_test("Get Document Content", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Get Document Content", False, f"Error: {str(e)}")
+            return False
+    
+    def test_lab_trend(self):
+        """Test PUT /documents/{doc_id} with lab results and GET /labs/{analyte}/trend"""
+        if not self.token or not self.document_id:
+            self.log_test("Lab Trend", False, "No token or document ID available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            payload = {
+                "lab_results": [
+                    {"analyte": "glucose", "value": 112, "unit": "mg/dL", "ref_low": 70, "ref_high": 100}
+                ]
+            }
+            update = requests.put(f"{self.base_url}/documents/{self.document_id}", 
+                                json=payload, params=params, timeout=10)
+            response = requests.get(f"{self.base_url}/labs/glucose/trend", 
+                                  params=params, timeout=10)
+            
+            if update.status_code == 200 and response.status_code == 200:
+                data = response.json()
+                points = [p for p in data.get("points", []) if p.get("doc_id") == self.document_id]
+                success = len(points) == 1 and points[0].get("out_of_range") is True
+                details = f"Status: {response.status_code}, Points: {len(data.get('points', []))}, Latest: {data.get('latest')}"
+            else:
+                success = False
+                details = f"Update status: {update.status_code}, Trend status: {response.status_code}, Response: {response.text}"
+                
+            self.log_test("Lab Trend", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Lab Trend", False, f"Error: {str(e)}")
+            return False
+    
+    def test_export_archive(self):
+        """Test GET /export"""
+        if not self.token:
+            self.log_test("Export Archive", False, "No token available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            response = requests.get(f"{self.base_url}/export", 
+                                  params=params, timeout=30)
+            
+            if response.status_code == 200:
+                archive = zipfile.ZipFile(io.BytesIO(response.content))
+                names = archive.namelist()
+                success = "documents.json" in names and "chats.json" in names and archive.testzip() is None
+                details = f"Status: {response.status_code}, Entries: {len(names)}, Bytes: {len(response.content)}"
+            else:
+                success = False
+                details = f"Status: {response.status_code}, Response: {response.text}"
+                
+            self.log_test("Export Archive", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Export Archive", False, f"Error: {str(e)}")
+            return False
+    
+    def test_lab_unit_mismatch(self):
+        """Test POST /documents rejects a lab result in a different unit than its series"""
+        if not self.token:
+            self.log_test("Lab Unit Mismatch", False, "No token available")
+            return False
+            
+        try:
+            payload = {
+                "title": "Kan Tahlili (mmol/L)",
+                "type": "blood_test",
+                "date": datetime.now().isoformat(),
+                "file_data": base64.b64encode(b"test").decode(),
+                "file_type": "pdf",
+                "lab_results": [{"analyte": "glucose", "value": 6.2, "unit": "mmol/L"}]
+            }
+            params = {"token": self.token}
+            response = requests.post(f"{self.base_url}/documents", 
+                                   json=payload, params=params, timeout=10)
+            
+            success = response.status_code == 400
+            details = f"Status: {response.status_code}, Response: {response.text}"
+                
+            self.log_test("Lab Unit Mismatch", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Lab Unit Mismatch", False, f"Error: {str(e)}")
+            return False
+    
+    def test_update_document_rejects_null(self):
+        """Test PUT /documents/{doc_id} rejects null for required fields"""
+        if not self.token or not self.document_id:
+            self.log_test("Update Document Rejects Null", False, "No token or document ID available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            statuses = [
+                requests.put(f"{self.base_url}/documents/{self.document_id}", 
+                           json={field: None}, params=params, timeout=10).status_code
+                for field in ("title", "type", "date")
+            ]
+            listing = requests.get(f"{self.base_url}/documents", 
+                                 params=params, timeout=10)
+            
+            success = statuses == [422, 422, 422] and listing.status_code == 200
+            details = f"Null update statuses: {statuses}, List status: {listing.status_code}"
+                
+            self.log_test("Update Document Rejects Null", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Update Document Rejects Null", False, f"Error: {str(e)}")
+            return False
+    
+    def test_conditional_get_documents(self):
+        """Test GET /documents with If-None-Match returns 304"""
+        if not self.token:
+            self.log_test("Conditional Get Documents", False, "No token available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            response = requests.get(f"{self.base_url}/documents", 
+                                  params=params, timeout=10)
+            etag = response.headers.get("ETag")
+            
+            if response.status_code == 200 and etag:
+                cached = requests.get(f"{self.base_url}/documents", params=params,
+                                      headers={"If-None-Match": etag}, timeout=10)
+                success = cached.status_code == 304 and not cached.content
+                details = f"Status: {cached.status_code}, ETag: {etag}"
+            else:
+                success = False
+                details = f"Status: {response.status_code}, ETag: {etag}"
+                
+            self.log_test("Conditional Get Documents", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Conditional Get Documents", False, f"Error: {str(e)}")
+            return False
+    
+    def test_sync_changes(self):
+        """Test GET /sync"""
+        if not self.token:
+            self.log_test("Sync Changes", False, "No token available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            response = requests.get(f"{self.base_url}/sync", 
+                                  params=params, timeout=10)
+            
+            if response.status_code == 200:
+                data = response.json()
+                doc_found = any(doc.get("id") == self.document_id for doc in data.get("documents", []))
+                self.sync_cursor = data.get("cursor")
+                success = doc_found and bool(self.sync_cursor)
+                details = f"Status: {response.status_code}, Cursor: {self.sync_cursor}, Created doc found: {doc_found}"
+            else:
+                success = False
+                details = f"Status: {response.status_code}, Response: {response.text}"
+                
+            self.log_test("Sync Changes", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Sync Changes", False, f"Error: {str(e)}")
+            return False
+    
+    def idempotency_payload(self, title):
+        return {
+            "title": title,
+            "type": "prescription",
+            "date": datetime.now().isoformat(),
+            "file_data": base64.b64encode(b"test").decode(),
+            "file_type": "pdf"
+        }
+    
+    def delete_documents(self, doc_ids):
+        for doc_id in set(doc_ids):
+            if doc_id:
+                requests.delete(f"{self.base_url}/documents/{doc_id}", 
+                              params={"token": self.token}, timeout=10)
+    
+    def test_idempotent_replay(self):
+        """Test POST /documents replays the first result for a repeated Idempotency-Key"""
+        if not self.token:
+            self.log_test("Idempotent Replay", False, "No token available")
+            return False
+            
+        try:
+            payload = self.idempotency_payload("Reçete (tekrar)")
+            params = {"token": self.token}
+            headers = {"Idempotency-Key": str(uuid.uuid4())}
+            first = requests.post(f"{self.base_url}/documents", json=payload, 
+                                params=params, headers=headers, timeout=10)
+            retry = requests.post(f"{self.base_url}/documents", json=payload, 
+                                params=params, headers=headers, timeout=10)
+            ids = [r.json().get("id") for r in (first, retry) if r.status_code == 200]
+            
+            success = len(ids) == 2 and ids[0] == ids[1]
+            details = f"Status: {first.status_code}/{retry.status_code}, IDs: {ids}"
+            self.delete_documents(ids)
+                
+            self.log_test("Idempotent Replay", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Idempotent Replay", False, f"Error: {str(e)}")
+            return False
+    
+    def test_idempotency_key_reuse(self):
+        """Test POST /documents rejects a repeated Idempotency-Key with a different body"""
+        if not self.token:
+            self.log_test("Idempotency Key Reuse", False, "No token available")
+            return False
+            
+        try:
+            params = {"token": self.token}
+            headers = {"Idempotency-Key": str(uuid.uuid4())}
+            first = requests.post(f"{self.base_url}/documents", json=self.idempotency_payload("Reçete A"), 
+                                params=params, headers=headers, timeout=10)
+            reused = requests.post(f"{self.base_url}/documents", json=self.idempotency_payload("Reçete B"), 
+                                 params=params, headers=headers, timeout=10)
+            
+            success = first.status_code == 200 and reused.status_code == 422
+            details = f"Status: {first.status_code}/{reused.status_code}, Response: {reused.text}"
+            if first.status_code == 200:
+                self.delete_documents([first.json().get("id")])
+                
+            self.log_test("Idempotency Key Reuse", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Idempotency Key Reuse", False, f"Error: {str(e)}")
+            return False
+    
+    def test_idempotent_concurrent(self):
+        """Test concurrent POST /documents with one Idempotency-Key create a single document"""
+        if not self.token:
+            self.log_test("Idempotent Concurrent", False, "No token available")
+            return False
+            
+        try:
+            payload = self.idempotency_payload("Reçete (eşzamanlı)")
+            params = {"token": self.token}
+            headers = {"Idempotency-Key": str(uuid.uuid4())}
+            
+            def post(_):
+                return requests.post(f"{self.base_url}/documents", json=payload, 
+                                   params=params, headers=headers, timeout=30)
+            
+            with ThreadPoolExecutor(max_workers=4) as pool:
+                responses = list(pool.map(post, range(4)))
+            statuses = [r.status_code for r in responses]
+            ids = [r.json().get("id") for r in responses if r.status_code == 200]
+            
+            success = statuses == [200] * 4 and len(set(ids)) == 1
+            details = f"Statuses: {statuses}, Distinct IDs: {len(set(ids))}"
+            self.delete_documents(ids)
+                
+            self.log_test("Idempotent Concurrent", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Idempotent Concurrent", False, f"Error: {str(e)}")
+            return False
+    
+    def ws_connect(self, resume=None):
+        url = f"{self.base_url.replace('http', 'ws', 1)}/ws?token={self.token}"
+        if resume is not None:
+            url += f"&resume={resume}"
+        return websocket.create_connection(url, timeout=10)
+    
+    def ws_receive(self, ws):
+        """Return the next frame, skipping server heartbeat pings"""
+        while True:
+            frame = json.loads(ws.recv())
+            if frame.get("type") != "ping":
+                return frame
+    
+    def test_ws_hello(self):
+        """Test /ws greets with the current sync sequence"""
+        if not self.token:
+            self.log_test("WebSocket Hello", False, "No token available")
+            return False
+            
+        try:
+            ws = self.ws_connect()
+            try:
+                frame = self.ws_receive(ws)
+            finally:
+                ws.close()
+            
+            success = frame.get("type") == "hello" and isinstance(frame.get("seq"), int)
+            details = f"Frame: {frame}"
+                
+            self.log_test("WebSocket Hello", success, details)
+            return success
+        except Exception as e:
+            self.log_test("WebSocket Hello", False, f"Error: {str(e)}")
+            return False
+    
+    def test_ws_ping_pong(self):
+        """Test /ws answers a client ping with a pong"""
+        if not self.token:
+            self.log_test("WebSocket Ping Pong", False, "No token available")
+            return False
+            
+        try:
+            ws = self.ws_connect()
+            try:
+                self.ws_receive(ws)
+                ws.send("ping")
+                frame = self.ws_receive(ws)
+            finally:
+                ws.close()
+            
+            success = frame.get("type") == "pong"
+            details = f"Frame: {frame}"
+                
+            self.log_test("WebSocket Ping Pong", success, details)
+            return success
+        except Exception as e:
+            self.log_test("WebSocket Ping Pong", False, f"Error: {str(e)}")
+            return False
+    
+    def test_ws_document_created(self):
+        """Test /ws pushes document.created after POST /documents"""
+        if not self.token:
+            self.log_test("WebSocket Document Created", False, "No token available")
+            return False
+            
+        try:
+            ws = self.ws_connect()
+            try:
+                hello = self.ws_receive(ws)
+                response = requests.post(f"{self.base_url}/documents", json=self.idempotency_payload("Reçete (bildirim)"), 
+                                       params={"token": self.token}, timeout=10)
+                doc_id = response.json().get("id") if response.status_code == 200 else None
+                frame = self.ws_receive(ws) if doc_id else {}
+            finally:
+                ws.close()
+            
+            success = (frame.get("type") == "document.created" and frame.get("id") == doc_id
+                       and frame.get("seq", 0) > hello.get("seq", 0))
+            details = f"Status: {response.status_code}, Frame: {frame}"
+            self.delete_documents([doc_id])
+                
+            self.log_test("WebSocket Document Created", success, details)
+            return success
+        except Exception as e:
+            self.log_test("WebSocket Document Created", False, f"Error: {str(e)}")
+            return False
+    
+    def test_ws_resume_resync(self):
+        """Test /ws asks a client resuming from an older sequence to resync"""
+        if not self.token:
+            self.log_test("WebSocket Resume Resync", False, "No token available")
+            return False
+            
+        try:
+            ws = self.ws_connect(resume=0)
+            try:
+                hello = self.ws_receive(ws)
+                frame = self.ws_receive(ws)
+            finally:
+                ws.close()
+            
+            success = frame.get("type") == "resync" and frame.get("seq") == hello.get("seq")
+            details = f"Hello: {hello}, Frame: {frame}"
+                
+            self.log_test("WebSocket Resume Resync", success, details)
+            return success
+        except Exception as e:
+            self.log_test("WebSocket Resume Resync", False, f"Error: {str(e)}")
+            return False
+    
     def test_chat_with_assistant(self):
         """Test POST /chat (already working according to test_result.md)"""
         if not self.token:
@@ -325,6 +727,68 @@ class VitaMedAPITester:
             self.log_test("Get Chat History", False, f"Error: {str(e)}")
             return False
     
+    def test_chat_history_paging(self):
+        """Test GET /chat/history pages with a UTC 'before' through hot and archived chats"""
+        if not self.token:
+            self.log_test("Chat History Paging", False, "No token available")
+            return False
+            
+        try:
+            params = {"token": self.token, "limit": 200}
+            full = requests.get(f"{self.base_url}/chat/history", params=params, timeout=10).json()
+            
+            paged = []
+            before = "2100-01-01T00:00:00Z"
+            statuses = set()
+            while len(paged) <= len(full):
+                response = requests.get(f"{self.base_url}/chat/history", 
+                                      params={"token": self.token, "limit": 2, "before": before}, timeout=10)
+                statuses.add(response.status_code)
+                page = response.json() if response.status_code == 200 else []
+                if not page:
+                    break
+                paged += page
+                before = page[-1]["created_at"].split("+")[0].rstrip("Z") + "Z"
+            
+            ids = [chat["id"] for chat in paged]
+            success = statuses == {200} and ids == [chat["id"] for chat in full]
+            details = f"Statuses: {sorted(statuses)}, Paged: {len(ids)}, Full: {len(full)}"
+                
+            self.log_test("Chat History Paging", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Chat History Paging", False, f"Error: {str(e)}")
+            return False
+    
+    def test_sync_includes_chat_history(self):
+        """Test a full GET /sync returns every chat in /chat/history, archived ones included"""
+        if not self.token:
+            self.log_test("Sync Includes Chat History", False, "No token available")
+            return False
+            
+        try:
+            history = requests.get(f"{self.base_url}/chat/history", 
+                                 params={"token": self.token, "limit": 200}, timeout=10).json()
+            
+            synced = set()
+            params = {"token": self.token, "limit": 50}
+            for _ in range(100):
+                data = requests.get(f"{self.base_url}/sync", params=params, timeout=10).json()
+                synced.update(chat["id"] for chat in data.get("chats", []))
+                params["since"] = data.get("cursor")
+                if not data.get("has_more"):
+                    break
+            
+            missing = [chat["id"] for chat in history if chat["id"] not in synced]
+            success = bool(history) and not missing
+            details = f"History: {len(history)}, Synced: {len(synced)}, Missing: {missing[:5]}"
+                
+            self.log_test("Sync Includes Chat History", success, details)
+            return success
+        except Exception as e:
+            self.log_test("Sync Includes Chat History", False, f"Error: {str(e)}")
+            return False
+    
     def test_delete_document(self):
         """Test DELETE /documents/{doc_id}"""
         if not self.token or not self.document_id:
@@ -373,10 +837,28 @@ class VitaMedAPITester:
         results["create_document"] = self.test_create_document()
         results["get_documents"] = self.test_get_documents()
         results["get_single_document"] = self.test_get_single_document()
+        results["get_document_content"] = self.test_get_document_content()
+        results["lab_trend"] = self.test_lab_trend()
+        results["lab_unit_mismatch"] = self.test_lab_unit_mismatch()
+        results["update_rejects_null"] = self.test_update_document_rejects_null()
+        results["conditional_get_documents"] = self.test_conditional_get_documents()
+        results["sync_changes"] = self.test_sync_changes()
+        results["idempotent_replay"] = self.test_idempotent_replay()
+        results["idempotency_key_reuse"] = self.test_idempotency_key_reuse()
+        results["idempotent_concurrent"] = self.test_idempotent_concurrent()
+        
+        # Change notification tests
+        results["ws_hello"] = self.test_ws_hello()
+        results["ws_ping_pong"] = self.test_ws_ping_pong()
+        results["ws_document_created"] = self.test_ws_document_created()
+        results["ws_resume_resync"] = self.test_ws_resume_resync()
         
         # Chat tests
         results["chat_assistant"] = self.test_chat_with_assistant()
         results["chat_history"] = self.test_get_chat_history()
+        results["chat_history_paging"] = self.test_chat_history_paging()
+        results["sync_chat_history"] = self.test_sync_includes_chat_history()
+        results["export_archive"] = self.test_export_archive()
         
         # Cleanup - delete test document
         results["delete_document"] = self.test_delete_document()
@@ -13,6 +13,7 @@ import { Ionicons } from '@expo/vector-icons';
 import { useRouter } from 'expo-router';
 import { useAuth } from '../../src/context/AuthContext';
 import { api } from '../../src/services/api';
+import { useChangeFeed } from '../../src/services/changes';
 
 interface Document {
   id: string;
@@ -51,6 +52,9 @@ export default function DocumentsScreen() {
     fetchDocuments();
   }, [fetchDocuments]);
 
+  // Uploads and deletes from other screens or devices arrive over the socket
+  useChangeFeed(token, ['document'], fetchDocuments);
+
   useEffect(() => {
     if (filter === 'all') {
       setFilteredDocs(documents);
@@ -20,6 +20,7 @@ import Animated, {
 } from 'react-native-reanimated';
 import { useAuth } from '../../src/context/AuthContext';
 import { api } from '../../src/services/api';
+import { useChangeFeed } from '../../src/services/changes';
 import { InfoCard } from '../../src/components/InfoCard';
 import { PrimaryButton } from '../../src/components/PrimaryButton';
 
@@ -53,6 +54,8 @@ export default function HomeScreen() {
     fetchRecentDocs();
   }, [fetchRecentDocs]);
 
+  useChangeFeed(token, ['document'], fetchRecentDocs);
+
   const onRefresh = useCallback(async () => {
     setRefreshing(true);
     await fetchRecentDocs();
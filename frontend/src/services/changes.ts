@@ -0,0 +1,69 @@
+import { useEffect, useRef } from 'react';
+import { BACKEND_URL } from './api';
+
+type ChangeKind = 'document' | 'chat';
+
+interface ChangeEvent {
+  type: string;
+  id?: string;
+  seq?: number;
+}
+
+const RETRY_MIN_MS = 2000;
+const RETRY_MAX_MS = 30000;
+
+// Subscribes to /api/ws and calls onChange whenever an item of one of the
+// given kinds changes, or the server asks for a resync. Reconnects with
+// backoff and resumes from the last seen sequence so missed events surface
+// as a resync.
+export const useChangeFeed = (
+  token: string | null,
+  kinds: ChangeKind[],
+  onChange: () => void
+) => {
+  const onChangeRef = useRef(onChange);
+  onChangeRef.current = onChange;
+  const kindsKey = kinds.join(',');
+
+  useEffect(() => {
+    if (!token) return;
+    let socket: WebSocket | null = null;
+    let retryTimer: ReturnType<typeof setTimeout> | null = null;
+    let retryMs = RETRY_MIN_MS;
+    let lastSeq: number | null = null;
+    let closed = false;
+
+    const connect = () => {
+      const resume = lastSeq === null ? '' : `&resume=${lastSeq}`;
+      socket = new WebSocket(`${BACKEND_URL.replace(/^http/, 'ws')}/api/ws?token=${token}${resume}`);
+
+      socket.onmessage = (message) => {
+        const event: ChangeEvent = JSON.parse(message.data);
+        if (event.type === 'hello') {
+          retryMs = RETRY_MIN_MS;
+        } else if (
+          event.type === 'resync' ||
+          kindsKey.split(',').includes(event.type.split('.')[0])
+        ) {
+          onChangeRef.current();
+        }
+        if (typeof event.seq === 'number') {
+          lastSeq = Math.max(lastSeq ?? 0, event.seq);
+        }
+      };
+
+      socket.onclose = () => {
+        if (closed) return;
+        retryTimer = setTimeout(connect, retryMs);
+        retryMs = Math.min(retryMs * 2, RETRY_MAX_MS);
+      };
+    };
+
+    connect();
+    return () => {
+      closed = true;
+      if (retryTimer) clearTimeout(retryTimer);
+      socket?.close();
+    };
+  }, [token, kindsKey]);
+};